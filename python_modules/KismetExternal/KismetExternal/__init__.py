@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 # Python implementation of the simple API for communicating with Kismet
 # via the Kismet External API
@@ -14,18 +14,84 @@ datasource capture, etc.
 """
 
 import argparse
+import collections
 import errno
 import fcntl
+import io
+import itertools
 import os
-import select
+import selectors
 import struct
 import sys
 import threading
 import time
 
-import kismet_pb2
-import http_pb2
-import datasource_pb2
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Prefer the C++-backed protobuf runtime when the extension is built; it
+# parses and serializes far faster than the pure-python fallback.  The
+# implementation is chosen at the first google.protobuf import, so this
+# must happen before the generated modules load; an explicit user
+# setting always wins.
+if "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION" not in os.environ:
+    try:
+        from google.protobuf.pyext import _message
+        os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "cpp"
+    except ImportError:
+        pass
+
+from . import kismet_pb2
+from . import http_pb2
+from . import datasource_pb2
+
+# Compiled once; frame header is (signature, checksum, length)
+FRAME_HEADER = struct.Struct("!III")
+
+# Stay under IOV_MAX segments per writev call
+WRITEV_MAX_SEGS = 512
+
+# JIT-compiled checksum kernel; a single native pass with no temporary
+# arrays, so it beats the two-reduction numpy path when numba is
+# installed.  Masking s2 to 16 bits before the shift keeps the math in
+# int64 range (only the low 16 bits of each sum survive the combine).
+_adler32_jit = None
+
+if numba is not None and numpy is not None:
+    @numba.njit(cache=True)
+    def _adler32_jit(buf):
+        # 4-way unrolled like Adler32IncrementalChecksum in util.cc: the
+        # byte loads and weighted partial sums in a block are independent,
+        # so the serial s2 dependency only advances once per 4 bytes
+        n = buf.shape[0]
+        s1 = 0
+        s2 = 0
+        i = 0
+
+        while i + 4 <= n:
+            b0 = buf[i]
+            b1 = buf[i + 1]
+            b2 = buf[i + 2]
+            b3 = buf[i + 3]
+
+            s2 += 4 * (s1 + b0) + 3 * b1 + 2 * b2 + b3
+            s1 += b0 + b1 + b2 + b3
+
+            i += 4
+
+        while i < n:
+            s1 += buf[i]
+            s2 += s1
+            i += 1
+
+        return (s1 & 0xFFFF) + ((s2 & 0xFFFF) << 16)
 
 class KismetExternalInterface:
     """ 
@@ -48,16 +114,46 @@ class KismetExternalInterface:
 
         self.cmdnum = 0
 
+        # Command envelope reused for every transmitted packet; guarded
+        # by bufferlock along with the sequence number
+        self.txcmd = kismet_pb2.Command()
+
+        # Heartbeat reply reused for every PING; only touched by the I/O
+        # thread
+        self.pongmsg = kismet_pb2.Pong()
+
         fl = fcntl.fcntl(infd, fcntl.F_GETFL)
         fcntl.fcntl(infd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
         fl = fcntl.fcntl(outfd, fcntl.F_GETFL)
         fcntl.fcntl(outfd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
-        self.wbuffer = ""
-        self.rbuffer = ""
-
-        self.bufferlock = threading.RLock()
+        # Unbuffered raw reader over a dup of the input fd; readinto()
+        # fills the receive ring directly with no intermediate bytes
+        # object per read
+        self.inreader = io.FileIO(os.dup(infd), 'r')
+
+        # Scalable readiness polling (epoll/kqueue via DefaultSelector);
+        # the output fd is registered only while transmit data is pending
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.infd, selectors.EVENT_READ)
+        self.selector_writing = False
+
+        # Transmit queue of framed segments; segments are written with
+        # vectored I/O rather than coalesced into one buffer
+        self.wbuffer = collections.deque()
+
+        # Receive ring: a preallocated buffer with head/tail indices so
+        # consuming a packet just advances the head instead of moving the
+        # tail of the buffer down after every frame
+        self.rbuffer = bytearray(65536)
+        self.r_head = 0
+        self.r_tail = 0
+
+        # Guards the transmit queue, the reused command envelope, and the
+        # sequence number; the receive ring is only ever touched by the
+        # I/O thread and needs no locking
+        self.bufferlock = threading.Lock()
 
         self.kill_ioloop = False
 
@@ -84,108 +180,208 @@ class KismetExternalInterface:
         self.MSG_FATAL = kismet_pb2.MsgbusMessage.FATAL
 
     def __adler32(self, data):
+        # The Kismet external protocol checksum is NOT standard Adler-32
+        # (the sums start at zero, are never reduced mod 65521, and inputs
+        # under 4 bytes checksum to zero), so zlib.adler32 cannot be
+        # substituted here; this must stay in sync with Adler32Checksum
+        # in util.cc
         if len(data) < 4:
             return 0
 
-        s1 = 0
-        s2 = 0
+        if _adler32_jit is not None:
+            buf = numpy.frombuffer(data, dtype=numpy.uint8)
+            return int(_adler32_jit(buf))
 
-        last_i = 0
+        if numpy is not None:
+            # Since the sums are never reduced mod 65521 they reorder
+            # freely: s1 is a plain sum, and s2 (the sum of the running
+            # prefix sums) collapses to a reversed-index weighted sum.
+            # 64-bit accumulators cannot overflow for any frame size the
+            # protocol allows, so no block splitting is needed.
+            buf = numpy.frombuffer(data, dtype=numpy.uint8)
+            s1 = int(buf.sum(dtype=numpy.uint64))
+            weights = numpy.arange(len(buf), 0, -1, dtype=numpy.uint64)
+            s2 = int(numpy.dot(buf, weights))
 
-        for i in range(0, len(data) - 4, 4):
-            s2 += 4 * (s1 + ord(data[i])) + 3 * ord(data[i + 1]) + 2 * ord(data[i + 2]) + ord(data[i + 3])
-            s1 += ord(data[i + 0]) + ord(data[i + 1]) + ord(data[i + 2]) + ord(data[i + 3])
-            last_i = i + 4
+            return ((s1 & 0xFFFF) + (s2 << 16)) & 0xFFFFFFFF
 
-        for i in range(last_i, len(data)):
-            s1 += ord(data[i])
+        s1 = 0
+        s2 = 0
+
+        for b in data:
+            s1 += b
             s2 += s1
 
         return ((s1 & 0xFFFF) + (s2 << 16)) & 0xFFFFFFFF
 
+    def __poll_io(self, want_write):
+        # Wait up to a second for I/O readiness; returns (readable, writable)
+        if want_write and not self.selector_writing:
+            self.selector.register(self.outfd, selectors.EVENT_WRITE)
+            self.selector_writing = True
+        elif not want_write and self.selector_writing:
+            self.selector.unregister(self.outfd)
+            self.selector_writing = False
+
+        readable = False
+        writable = False
+
+        for (key, events) in self.selector.select(1):
+            if key.fd == self.infd and events & selectors.EVENT_READ:
+                readable = True
+            if key.fd == self.outfd and events & selectors.EVENT_WRITE:
+                writable = True
+
+        return (readable, writable)
+
     def __io_loop(self):
         try:
             while not self.kill_ioloop:
                 if not self.last_pong == 0 and time.time() - self.last_pong > 5:
                     raise RuntimeError("No PONG from remote system in 5 seconds")
 
-                inputs = [ self.infd ]
-                outputs = []
-
-                self.bufferlock.acquire()
-                try:
-                    if len(self.wbuffer):
-                        outputs = [ self.outfd ]
-                finally:
-                    self.bufferlock.release()
-
-                (readable, writable, exceptional) = select.select(inputs, outputs, inputs, 1)
+                # Reading the deque length is atomic under the GIL; no
+                # need to take the lock just to peek at it
+                want_write = len(self.wbuffer) > 0
 
-                if self.outfd in exceptional or self.infd in exceptional:
-                    raise BufferError("Buffer error:  Socket closed")
+                (readable, writable) = self.__poll_io(want_write)
 
-                if self.outfd in outputs:
-                    self.bufferlock.acquire()
+                if writable:
                     try:
-                        written = os.write(self.outfd, self.wbuffer)
+                        written = self.__write_wbuffer()
 
                         if written == 0:
                             raise BufferError("Output connection closed")
-
-                        self.wbuffer = self.wbuffer[written:]
                     except OSError as e:
                         if not e.errno == errno.EAGAIN:
                             raise BufferError("Output buffer error: {}".format(e))
-                    finally:
-                        self.bufferlock.release()
 
-                if self.infd in inputs:
-                    self.bufferlock.acquire()
+                if readable:
                     try:
-                        readdata = os.read(self.infd, 4096)
+                        if len(self.rbuffer) - self.r_tail < 4096:
+                            self.__compact_rbuffer()
+
+                        # readinto returns None when the non-blocking fd
+                        # has no data ready
+                        readlen = self.inreader.readinto(memoryview(self.rbuffer)[self.r_tail:])
 
-                        if len(readdata) == 0:
-                            raise BufferError("Input connection closed")
+                        if readlen is not None:
+                            if readlen == 0:
+                                raise BufferError("Input connection closed")
 
-                        self.rbuffer = self.rbuffer + readdata
-                        self.__recv_packet()
+                            self.r_tail += readlen
+
+                            self.__recv_packet()
                     except OSError as e:
                         if not e.errno == errno.EAGAIN:
                             raise BufferError("Input buffer error: {}".format(e))
-                    finally:
-                        self.bufferlock.release()
         finally:
             self.running = False
 
-    def __recv_packet(self):
-        if len(self.rbuffer) < 12:
-            return
+    def __write_wbuffer(self):
+        # Transmit as much of the queued segment list as the fd accepts;
+        # writev pushes all pending segments in one syscall without
+        # gluing them into a single buffer first.
+        #
+        # Only the I/O thread consumes the queue and other threads only
+        # append, so the head segments can be snapshotted under the lock
+        # and the write syscall itself made without holding it; the lock
+        # is retaken just to drop what was sent.
+        self.bufferlock.acquire()
+        try:
+            segs = list(itertools.islice(self.wbuffer, 0, WRITEV_MAX_SEGS))
+        finally:
+            self.bufferlock.release()
 
-        (signature, checksum, sz) = struct.unpack("!III", self.rbuffer[:12])
+        if len(segs) == 0:
+            return None
 
-        if not signature == 0xDECAFBAD:
-            raise BufferError("Invalid signature in packet header")
+        written = os.writev(self.outfd, segs)
 
-        if len(self.rbuffer) < 12 + sz:
+        self.bufferlock.acquire()
+        try:
+            remain = written
+
+            while remain and self.wbuffer:
+                seg = self.wbuffer[0]
+
+                if remain >= len(seg):
+                    self.wbuffer.popleft()
+                    remain -= len(seg)
+                else:
+                    # Partial write; keep the unsent tail as a zero-copy view
+                    self.wbuffer[0] = memoryview(seg)[remain:]
+                    remain = 0
+        finally:
+            self.bufferlock.release()
+
+        return written
+
+    def __compact_rbuffer(self):
+        # Slide the unconsumed region back to the start of the ring so the
+        # tail regains room; this copies once per trip around the buffer
+        # instead of once per consumed packet
+        if self.r_head == 0:
             return
 
-        content = self.rbuffer[12:(12 + sz)]
+        pending = self.r_tail - self.r_head
+
+        if pending:
+            self.rbuffer[0:pending] = self.rbuffer[self.r_head:self.r_tail]
+
+        self.r_head = 0
+        self.r_tail = pending
+
+    def __recv_packet(self):
+        # A single wakeup may deliver several frames; drain every complete
+        # one from the ring before going back to the selector
+        while True:
+            pending = self.r_tail - self.r_head
+
+            if pending < FRAME_HEADER.size:
+                return
+
+            (signature, checksum, sz) = FRAME_HEADER.unpack_from(self.rbuffer, self.r_head)
 
-        calc_csum = self.__adler32(content)
+            if not signature == 0xDECAFBAD:
+                raise BufferError("Invalid signature in packet header")
 
-        if not calc_csum == checksum:
-            print content.encode('hex')
-            raise BufferError("Invalid checksum in packet header {} vs {}".format(calc_csum, checksum))
+            if pending < 12 + sz:
+                # Grow the ring if a single frame can never fit in it
+                if 12 + sz > len(self.rbuffer):
+                    newsize = max(len(self.rbuffer) * 2, 12 + sz)
+                    self.rbuffer.extend(bytearray(newsize - len(self.rbuffer)))
 
+                return
+
+            content = memoryview(self.rbuffer)[(self.r_head + 12):(self.r_head + 12 + sz)].tobytes()
+
+            calc_csum = self.__adler32(content)
+
+            if not calc_csum == checksum:
+                raise BufferError("Invalid checksum in packet header {} vs {} ({} byte payload)".format(calc_csum, checksum, sz))
+
+            self.r_head = self.r_head + 12 + sz
+
+            if self.r_head == self.r_tail:
+                self.r_head = 0
+                self.r_tail = 0
+
+            self.__dispatch_packet(content)
+
+    def __dispatch_packet(self, content):
+        # Decode a deframed command payload and invoke its handler; kept
+        # separate from the framing layer so it does not care where the
+        # bytes came from
         cmd = kismet_pb2.Command()
         cmd.ParseFromString(content)
 
-        if cmd.command in self.handlers:
-            self.handlers[cmd.command](cmd.seqno, cmd.content)
-        else:
-            print "Unhandled", cmd.command
+        handler = self.handlers.get(cmd.command)
 
-        self.rbuffer = self.rbuffer[12 + sz:]
+        if handler is not None:
+            handler(cmd.seqno, cmd.content)
+        else:
+            print("Unhandled", cmd.command)
 
     def start(self):
         """
@@ -226,8 +422,12 @@ class KismetExternalInterface:
         if not method in self.uri_handlers:
             self.uri_handlers[method] = {}
 
-        if not uri in self.uri_handlers[method]:
-            self.uri_handlers[method][uri] = handler
+        # Kismet already knows this URI; re-registering would build and
+        # send a redundant packet
+        if uri in self.uri_handlers[method]:
+            return
+
+        self.uri_handlers[method][uri] = handler
 
         reguri = http_pb2.HttpRegisterUri()
         reguri.method = method
@@ -250,11 +450,7 @@ class KismetExternalInterface:
 
         :return: None
         """
-        self.bufferlock.acquire()
-        try:
-            self.kill_ioloop = True
-        finally:
-            self.bufferlock.release()
+        self.kill_ioloop = True
 
     def write_raw_packet(self, kedata):
         """
@@ -265,17 +461,17 @@ class KismetExternalInterface:
 
         :return: None
         """
-        signature = 0xDECAFBAD
+        # Serialize and checksum outside the lock; only the queue append
+        # needs it
         serial = kedata.SerializeToString()
         checksum = self.__adler32(serial)
-        length = len(serial)
 
-        packet = struct.pack("!III", signature, checksum, length)
+        packet = FRAME_HEADER.pack(0xDECAFBAD, checksum, len(serial))
 
         self.bufferlock.acquire()
         try:
-            self.wbuffer += packet
-            self.wbuffer += serial
+            self.wbuffer.append(packet)
+            self.wbuffer.append(serial)
         finally:
             self.bufferlock.release()
 
@@ -288,15 +484,29 @@ class KismetExternalInterface:
 
         :return: None
         """
-        cp = kismet_pb2.Command()
+        # Serialize the payload before taking the lock; the envelope and
+        # sequence number are filled, framed, and queued in one section so
+        # frames always hit the wire in seqno order
+        payload = content.SerializeToString()
+
+        self.bufferlock.acquire()
+        try:
+            cp = self.txcmd
+            cp.Clear()
 
-        cp.command = cmdtype
-        cp.seqno = self.cmdnum
-        cp.content = content.SerializeToString()
+            cp.command = cmdtype
+            cp.seqno = self.cmdnum
+            cp.content = payload
 
-        self.write_raw_packet(cp)
+            serial = cp.SerializeToString()
+            checksum = self.__adler32(serial)
 
-        self.cmdnum = self.cmdnum + 1
+            self.wbuffer.append(FRAME_HEADER.pack(0xDECAFBAD, checksum, len(serial)))
+            self.wbuffer.append(serial)
+
+            self.cmdnum = self.cmdnum + 1
+        finally:
+            self.bufferlock.release()
 
     def send_message(self, message, msgtype = kismet_pb2.MsgbusMessage.INFO):
         """
@@ -325,9 +535,8 @@ class KismetExternalInterface:
         self.write_ext_packet("PING", ping)
 
     def __send_pong(self, seqno):
-        pong = kismet_pb2.Pong()
-        pong.ping_seqno = seqno
-        self.write_ext_packet("PONG", pong)
+        self.pongmsg.ping_seqno = seqno
+        self.write_ext_packet("PONG", self.pongmsg)
 
     def request_http_auth(self, callback = None):
         """
@@ -388,28 +597,32 @@ class KismetExternalInterface:
         # Set the response
         resp.req_id = req_id
 
-        # Break the data into chunks and send each chunk as part of the response
-        for block in range(0, len(data), 1024):
-            resp.content = data[block:block+1024]
+        # The wire carries bytes; encode str payloads once up front
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        # Break the data into chunks and send each chunk as part of the
+        # response; slicing through a memoryview copies each chunk once,
+        # into the message, instead of materializing an intermediate
+        # slice of the full payload as well
+        mv = memoryview(data)
+        for block in range(0, len(mv), 1024):
+            resp.content = mv[block:block + 1024].tobytes()
             self.write_ext_packet("HTTPRESPONSE", resp)
 
         # Do we finish it up?
         if not stream or (stream and finished):
-            resp.content = ""
+            resp.content = b""
             resp.resultcode = resultcode
             resp.close_response = True
             self.write_ext_packet("HTTPRESPONSE", resp)
 
     def __handle_ping(self, seqno, packet):
-        ping = kismet_pb2.Ping()
-        ping.ParseFromString(packet)
-
+        # The heartbeat payloads carry nothing; reply (and record a pong)
+        # without decoding them
         self.__send_pong(seqno)
 
     def __handle_pong(self, seqno, packet):
-        pong = kismet_pb2.Pong()
-        pong.ParseFromString(packet)
-
         self.last_pong = time.time()
 
     def __handle_shutdown(self, seqno, packet):
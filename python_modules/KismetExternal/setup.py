@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 from setuptools import setup
 
@@ -9,6 +9,10 @@ setup(name='KismetExternal',
       author_email='dragorn@kismetwireless.net',
       url='https://www.kismetwireless.net/',
       install_requires=['protobuf'],
+      extras_require={
+          'fast': ['numpy'],
+          'jit': ['numba'],
+      },
       packages=['KismetExternal'],
      )
 